@@ -1,13 +1,39 @@
+import hashlib
+import hmac
 import json
 import logging
+import os
+import random
+import time
 
 import webapp2
 from google.appengine.ext import ndb
 
 import engine
+import ratelimit
+import tournament
 
+# Commands that start or end a game, rather than playing it.
+GAME_LIFECYCLE_COMMANDS = ('deal', 'new', 'restart', 'start', 'cancel', 'end')
 
-def deal_cards(existing_game, game_id, players):
+# Commands that don't change the game, so we don't record them as moves.
+READ_ONLY_COMMANDS = ('status', 'state', 'export', 'view', 'board', 'cards',
+                      'money', 'me', 'look')
+
+# How old a signed request can be before we assume it's a replay.
+MAX_REQUEST_AGE = 5 * 60
+
+# Where we get each command's seed.  It reads os.urandom, so the seeds in one
+# export don't tell you anything about the seeds of any other moves.
+_system_random = random.SystemRandom()
+
+
+class NoGame(engine.Misplay):
+    """There's no game to run a command in."""
+    pass
+
+
+def deal_cards(existing_game, game_id, players, rng=random):
     if existing_game and not existing_game.winner():
         raise engine.Misplay("There's already a game running in this room!  "
                              "To cancel it and start a new one, "
@@ -17,7 +43,7 @@ def deal_cards(existing_game, game_id, players):
                              "To start a new game, `/coup deal [usernames]`.")
     elif len(list(set(players))) != len(players):
         raise engine.Misplay("The players must be unique.")
-    game = engine.GameState.create(game_id, players)
+    game = engine.GameState.create(game_id, players, rng)
     game.put()
     return {
         'response_type': 'in_channel',
@@ -39,29 +65,37 @@ def cancel_game(game):
 
 # TODO(benkraft): here and elsewhere, don't hardcode that it's `/coup`, use
 # whatever it was called with.
-def run_command(game, game_id, username, args):
+def run_command(game, game_id, username, args, rng=random):
+    """Run a command; rng is what to shuffle with."""
     if not args:
         # TODO(benkraft): return help
         raise engine.Misplay("What do you want to do?")
     # These don't need an existing game or a player.
     if args[0] in ('deal', 'new', 'start'):
-        return deal_cards(game, game_id, args[1:])
+        return deal_cards(game, game_id, args[1:], rng)
     elif args[0] == 'restart':
         if game:
             cancel_game(game)
-        return deal_cards(None, game_id, args[1:])
+        return deal_cards(None, game_id, args[1:], rng)
 
     # These need a game, but not necessarily a player.
     if not game:
-        raise engine.Misplay("There's no game running in this channel.  "
-                             "To start a new game, `/coup deal`.")
-    elif args[0] in ('cancel', 'end'):
+        raise NoGame("There's no game running in this channel.  "
+                     "To start a new game, `/coup deal`.")
+    game.rng = rng
+    if args[0] in ('cancel', 'end'):
         return cancel_game(game)
     elif args[0] in ('status', 'state'):
         return {
             'response_type': 'in_channel',
             'text': game.status_view(),
         }
+    elif args[0] == 'export':
+        return {
+            'response_type': 'ephemeral',
+            'text': "To replay this game, save this to a file and "
+                    "`python replay.py <file>`.\n```%s```" % game.export(),
+        }
 
     # TODO(benkraft): turn this mode off when testing is done.  (Or don't.)
     if len(args) >= 3 and args[-2] == 'as':
@@ -150,6 +184,11 @@ def run_command(game, game_id, username, args):
             'response_type': 'in_channel',
             'text': game.lose_card(player, args[1]),
         }
+    elif args[0] in ('forfeit', 'resign'):
+        return {
+            'response_type': 'in_channel',
+            'text': game.forfeit(player),
+        }
 
     if args[0] in engine.ACTIONS:
         raise engine.Misplay("To take an action, "
@@ -159,42 +198,217 @@ def run_command(game, game_id, username, args):
         raise engine.Misplay("I don't know of a command %s." % args[0])
 
 
+def start_tournament(existing_tournament, existing_game, tournament_id,
+                     players):
+    if existing_tournament and not existing_tournament.winner:
+        raise engine.Misplay("There's already a tournament running in this "
+                             "room!  To cancel it, `/coup tournament cancel`.")
+    elif existing_game and not existing_game.winner():
+        raise engine.Misplay("There's already a game running in this room!  "
+                             "To cancel it, `/coup cancel`.")
+    new_tournament, text, games = tournament.Tournament.create(
+        tournament_id, players)
+    # Each table is its own entity group, so rather than a transaction, we
+    # put them all in one batch.
+    ndb.put_multi([new_tournament] + games)
+    # Clear out the finished game or tournament this replaces, so that
+    # commands go to the new tables.
+    old_keys = []
+    if existing_game:
+        old_keys.append(existing_game.key)
+    if existing_tournament:
+        old_keys.extend(_table_keys(existing_tournament))
+    ndb.delete_multi(old_keys)
+    return {
+        'response_type': 'in_channel',
+        'text': "Welcome to the tournament!  Use `/coup standings` to see how "
+                "it's going.\n%s" % text,
+    }
+
+
+def _table_keys(existing_tournament):
+    return [ndb.Key(engine.GameState, game_id)
+            for game_id in existing_tournament.game_ids]
+
+
+def cancel_tournament(existing_tournament):
+    ndb.delete_multi([existing_tournament.key] +
+                     _table_keys(existing_tournament))
+    return {
+        'response_type': 'in_channel',
+        'text': "Tournament over, everyone loses.  To start a new one, "
+                "`/coup tournament [usernames]`.",
+    }
+
+
+def run_tournament_command(existing_tournament, existing_game, tournament_id,
+                           args):
+    if args[0] == 'tournament' and args[1:] != ['cancel']:
+        return start_tournament(existing_tournament, existing_game,
+                                tournament_id, args[1:])
+
+    if not existing_tournament:
+        raise engine.Misplay("There's no tournament running in this channel.  "
+                             "To start one, `/coup tournament [usernames]`.")
+    elif args[0] == 'tournament':  # args[1] == 'cancel'
+        return cancel_tournament(existing_tournament)
+    else:  # args[0] == 'standings'
+        return {
+            'response_type': 'in_channel',
+            'text': existing_tournament.standings_view(),
+        }
+
+
+@ndb.non_transactional
+def _put_games(games):
+    """Put games from inside a transaction, as each is its own group."""
+    ndb.put_multi(games)
+
+
+def verify_request(request):
+    """Check that a request came from Slack.
+
+    Uses the signing secret if there is one, or else the (deprecated)
+    verification token.  If neither is configured, lets everything through on
+    the dev server, and nothing in production.
+    """
+    signing_secret = os.environ.get('SLACK_SIGNING_SECRET')
+    verification_token = os.environ.get('SLACK_VERIFICATION_TOKEN')
+    if signing_secret:
+        timestamp = request.headers.get('X-Slack-Request-Timestamp', '')
+        signature = request.headers.get('X-Slack-Signature', '')
+        try:
+            if abs(time.time() - int(timestamp)) > MAX_REQUEST_AGE:
+                return False
+        except ValueError:
+            return False
+        expected = 'v0=' + hmac.new(
+            signing_secret, 'v0:%s:%s' % (timestamp, request.body),
+            hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, str(signature))
+    elif verification_token:
+        return hmac.compare_digest(
+            verification_token, str(request.POST.get('token', '')))
+    elif os.environ.get('SERVER_SOFTWARE', '').startswith('Development'):
+        return True
+    logging.error("Neither SLACK_SIGNING_SECRET nor SLACK_VERIFICATION_TOKEN "
+                  "is set; rejecting all commands.")
+    return False
+
+
 class Command(webapp2.RequestHandler):
     # TODO(benkraft): GET handler that redirects to the github?
 
-    @ndb.transactional
     def post(self):
         """Endpoint for the slash command."""
-        # TODO(benkraft): check the token to prevent abuse?
         logging.debug(self.request.POST)
-        game_id = "%s#%s" % (self.request.POST['team_id'],
-                             self.request.POST['channel_id'])
-        game = engine.GameState.get_by_id(game_id)
-        username = self.request.POST['user_name']
-        args = self.request.POST['text'].split()
-        try:
-            answer = run_command(game, game_id, username, args)
-            if args[0] not in ('deal', 'new', 'restart', 'start', 'cancel',
-                               'end'):
-                # Don't put the game if we got an error, or if we started a new
-                # game.
-                # TODO(benkraft): do this in a less ad-hoc way.
-                game.put()
-        except engine.Misplay as e:
-            answer = {
-                'response_type': 'ephemeral',
-                "text": str(e),
-            }
-            logging.info("Misplay: %s" % e)
-        except Exception as e:
+        if not verify_request(self.request):
+            logging.warning("Rejected unverified request")
+            self.abort(403)
+        team_id = self.request.POST['team_id']
+        channel_id = self.request.POST['channel_id']
+        # Check this before we start a transaction, so that a flood of
+        # commands doesn't contend with real players for the game.
+        if ratelimit.check(team_id, channel_id,
+                           self.request.POST['user_id']):
             answer = {
                 'response_type': 'ephemeral',
-                "text": "Something went wrong!",
+                'text': ratelimit.MESSAGE,
             }
-            logging.exception(e)
+        else:
+            try:
+                answer = self._dispatch(
+                    "%s#%s" % (team_id, channel_id),
+                    self.request.POST['user_name'],
+                    self.request.POST['text'].split())
+            except engine.Misplay as e:
+                answer = {
+                    'response_type': 'ephemeral',
+                    "text": str(e),
+                }
+                logging.info("Misplay: %s" % e)
+            except Exception as e:
+                answer = {
+                    'response_type': 'ephemeral',
+                    "text": "Something went wrong!",
+                }
+                logging.exception(e)
         self.response.write(json.dumps(answer))
         self.response.content_type = 'application/json'
 
+    def _dispatch(self, game_id, username, args):
+        if args and args[0] in ('tournament', 'standings'):
+            return run_tournament_command(
+                tournament.Tournament.get_by_id(game_id),
+                engine.GameState.get_by_id(game_id), game_id, args)
+        elif args and args[0] in ('deal', 'new', 'start', 'restart'):
+            existing_tournament = tournament.Tournament.get_by_id(game_id)
+            if existing_tournament and not existing_tournament.winner:
+                raise engine.Misplay("There's a tournament running in this "
+                                     "room!  To cancel it, "
+                                     "`/coup tournament cancel`.")
+
+        try:
+            return self._run_command(game_id, username, args)[0]
+        except NoGame as e:
+            # We never deal a game in a channel with a tournament, so only
+            # now do we need to check if you're playing at one of its tables.
+            existing_tournament = tournament.Tournament.get_by_id(game_id)
+            if not existing_tournament:
+                raise e
+            elif args[0] == 'export':
+                # Your table's game can only be exported once it's over, so
+                # we look for it even if you've moved on.
+                table_id = existing_tournament.last_table_for(username)
+            else:
+                table_id = existing_tournament.table_for(username)
+            if not table_id:
+                raise e
+        if args[0] in GAME_LIFECYCLE_COMMANDS:
+            raise engine.Misplay("You're playing in a tournament!  To cancel "
+                                 "it, `/coup tournament cancel`.")
+        answer, game = self._run_command(table_id, username, args)
+        if args[0] not in READ_ONLY_COMMANDS and game.winner():
+            text = self._finish_table(game_id, game)
+            if text:
+                answer['text'] = '%s\n%s' % (answer['text'], text)
+        return answer
+
+    @ndb.transactional
+    def _run_command(self, game_id, username, args):
+        """Returns the answer, and the game."""
+        game = engine.GameState.get_by_id(game_id)
+        # Give the command its own seeded random, and record the seed with
+        # the move, so that replay.py can run it again the same way.  (Not
+        # the global random, or the seed would tell you what anything that
+        # shuffles with it next will do.)
+        seed = _system_random.getrandbits(32)
+        answer = run_command(game, game_id, username, args,
+                             random.Random(seed))
+        if args[0] not in GAME_LIFECYCLE_COMMANDS:
+            # Don't put the game if we started a new game.  (If we got an
+            # error, the transaction rolls back anyway.)
+            # TODO(benkraft): do this in a less ad-hoc way.
+            if args[0] not in READ_ONLY_COMMANDS:
+                game.record_move(username, ' '.join(args), seed)
+            game.put()
+        return answer, game
+
+    @ndb.transactional
+    def _finish_table(self, tournament_id, game):
+        """Record a finished table; start the next round if it's time."""
+        current_tournament = tournament.Tournament.get_by_id(tournament_id)
+        text, games = current_tournament.finish_table(game)
+        if games:
+            # The next round's tables are their own entity groups, so we put
+            # them outside the transaction, but before the tournament commits,
+            # so it never points at tables that don't exist.  If we fail after
+            # this, they're just orphans, which a retry overwrites.
+            _put_games(games)
+        if text:
+            current_tournament.put()
+        return text
+
 
 app = webapp2.WSGIApplication([
     ('/', Command),
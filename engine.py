@@ -1,4 +1,8 @@
+import base64
+import collections
+import json
 import random
+import zlib
 
 from google.appengine.ext import ndb
 
@@ -59,6 +63,103 @@ CARD_LOSS_ACTIONS = {'assassinate', 'coup'}
 
 ACTIONS_WITH_RESPONSE = CARD_LOSS_ACTIONS | {'exchange'}
 
+STATUSES = (
+    'READY',
+    'ACTED',
+    'CHALLENGED',
+    'CHALLENGE_LOST',
+    'CHALLENGE_LOSS_RESOLVED',
+    'BLOCKED',
+    'BLOCK_CHALLENGED',
+    'BLOCK_CHALLENGE_WON',
+    'BLOCK_CHALLENGE_LOST',
+    'CARDS_TAKEN',
+)
+
+# dict from command to how to use it
+COMMAND_USAGE = {
+    'action': '`/coup action <action> [target]`',
+    'challenge': '`/coup challenge`',
+    'show': '`/coup show <card>`',
+    'flip': '`/coup flip <card>`',
+    'block': '`/coup block <with_card>`',
+    'exchange': '`/coup exchange`',
+    'return': '`/coup return <card1> <card2>`',
+    'lose': '`/coup lose <card>`',
+}
+
+_ANY_ACTION = ACTIONS | {None}
+
+# The state machine.  Each row is
+#   (status, command, last actions, who may do it, possible next statuses)
+# meaning that in that status, if the last action was one of those, whoever
+# it names may make that command, and the game will end up in one of those
+# statuses.  Each command is handled by a GameState method: `action` by
+# take_action, `challenge` by pose_challenge, `show` by resolve_challenge,
+# `flip` by lose_challenge, `block` by pose_block, `exchange` by take_cards,
+# `return` by return_cards, and `lose` by lose_card.  "Who" is one of
+# 'next' (whose turn it is), 'last' (who took the last action), 'target' (of
+# the last action), 'challenger', 'challengee', or 'anyone'.
+TRANSITIONS = [
+    ('READY', 'action', _ANY_ACTION, 'next', {'READY', 'ACTED'}),
+    ('ACTED', 'action', _ANY_ACTION - ACTIONS_WITH_RESPONSE, 'next',
+     {'READY', 'ACTED'}),
+    ('ACTED', 'challenge', set(ACTION_CARDS), 'anyone',
+     {'CHALLENGED', 'CHALLENGE_LOST', 'CHALLENGE_LOSS_RESOLVED', 'READY'}),
+    ('ACTED', 'block', {'foreignaid'}, 'anyone', {'BLOCKED'}),
+    ('ACTED', 'block', set(ACTION_BLOCKS) - {'foreignaid'}, 'target',
+     {'BLOCKED'}),
+    ('ACTED', 'exchange', {'exchange'}, 'last', {'CARDS_TAKEN'}),
+    ('ACTED', 'lose', CARD_LOSS_ACTIONS, 'target', {'READY'}),
+    ('CHALLENGED', 'show', _ANY_ACTION, 'challengee',
+     {'CHALLENGE_LOST', 'CHALLENGE_LOSS_RESOLVED', 'READY'}),
+    ('CHALLENGE_LOST', 'flip', _ANY_ACTION, 'challenger',
+     {'CHALLENGE_LOSS_RESOLVED', 'READY'}),
+    ('CHALLENGE_LOSS_RESOLVED', 'action',
+     _ANY_ACTION - ACTIONS_WITH_RESPONSE, 'next', {'READY', 'ACTED'}),
+    ('CHALLENGE_LOSS_RESOLVED', 'block', {'foreignaid'}, 'anyone',
+     {'BLOCKED'}),
+    ('CHALLENGE_LOSS_RESOLVED', 'block', set(ACTION_BLOCKS) - {'foreignaid'},
+     'target', {'BLOCKED'}),
+    ('CHALLENGE_LOSS_RESOLVED', 'exchange', {'exchange'}, 'last',
+     {'CARDS_TAKEN'}),
+    ('CHALLENGE_LOSS_RESOLVED', 'lose', CARD_LOSS_ACTIONS, 'target',
+     {'READY'}),
+    # A blocked action waits on nobody, even if it would have.
+    ('BLOCKED', 'action', _ANY_ACTION, 'next', {'READY', 'ACTED'}),
+    ('BLOCKED', 'challenge', _ANY_ACTION, 'anyone',
+     {'BLOCK_CHALLENGED', 'BLOCK_CHALLENGE_LOST', 'BLOCK_CHALLENGE_WON',
+      'READY'}),
+    ('BLOCK_CHALLENGED', 'show', _ANY_ACTION, 'challengee',
+     {'BLOCK_CHALLENGE_LOST', 'BLOCK_CHALLENGE_WON', 'READY'}),
+    ('BLOCK_CHALLENGE_WON', 'exchange', {'exchange'}, 'last',
+     {'CARDS_TAKEN'}),
+    ('BLOCK_CHALLENGE_WON', 'lose', CARD_LOSS_ACTIONS, 'target', {'READY'}),
+    ('BLOCK_CHALLENGE_LOST', 'flip', _ANY_ACTION, 'challenger', {'READY'}),
+    ('CARDS_TAKEN', 'return', {'exchange'}, 'last', {'READY'}),
+]
+
+
+def _compile_transitions(transitions):
+    """Index the transitions by (status, last action).
+
+    Returns a dict from (status, last action) to an OrderedDict from command
+    to (who, next statuses), in the order of the table, for every status and
+    last action.
+    """
+    legal = {(status, action): collections.OrderedDict()
+             for status in STATUSES for action in _ANY_ACTION}
+    for status, command, actions, who, next_statuses in transitions:
+        for action in actions:
+            if command in legal[status, action]:
+                raise ValueError("Duplicate transition for %s in %s after %s"
+                                 % (command, status, action))
+            legal[status, action][command] = (who, frozenset(next_statuses))
+    return legal
+
+
+LEGAL_COMMANDS = _compile_transitions(TRANSITIONS)
+
 
 def _join_messages(msgs):
     return '\n'.join(msg for msg in msgs if msg)
@@ -124,6 +225,16 @@ class Player(ndb.Model):
         return isinstance(other, Player) and self.username == other.username
 
 
+class Move(ndb.Model):
+    """StructuredProperty on GameState."""
+    username = ndb.StringProperty()
+    text = ndb.StringProperty()
+    # What we seeded random with before running the command
+    seed = ndb.IntegerProperty()
+    # status_view() afterwards
+    view = ndb.TextProperty()
+
+
 class GameState(ndb.Model):
     """Per-game singleton to store the game state.
 
@@ -131,17 +242,7 @@ class GameState(ndb.Model):
     """
     last_action = ndb.StringProperty(required=False)
     last_action_target = ndb.StringProperty(required=False)
-    # One of:
-    # READY
-    # ACTED
-    # CHALLENGED
-    # CHALLENGE_LOST
-    # CHALLENGE_LOSS_RESOLVED
-    # BLOCKED
-    # BLOCK_CHALLENGED
-    # BLOCK_CHALLENGE_WON
-    # BLOCK_CHALLENGE_LOST
-    # CARDS_TAKEN
+    # One of STATUSES; see TRANSITIONS for how we get from one to another.
     status = ndb.StringProperty()
     challenger = ndb.StringProperty(required=False)
     blocker = ndb.StringProperty(required=False)
@@ -150,6 +251,14 @@ class GameState(ndb.Model):
     unused_cards = ndb.StructuredProperty(Card, repeated=True)
     # Next player first
     players = ndb.LocalStructuredProperty(Player, repeated=True)
+    # Usernames of players who are out, in the order they went out
+    eliminated = ndb.StringProperty(repeated=True)
+    # The game as dealt, and every move since, for export()
+    deal = ndb.JsonProperty(compressed=True)
+    moves = ndb.LocalStructuredProperty(Move, repeated=True, compressed=True)
+    # What to shuffle with; not stored.  Set it to a random.Random to make a
+    # command's shuffles repeatable without touching the global random state.
+    rng = random
 
     def remaining_players(self):
         return [player for player in self.players if not player.is_out()]
@@ -213,41 +322,140 @@ class GameState(ndb.Model):
         else:
             raise ValueError("Unknown status %s" % self.status)
 
+    def legal_commands(self):
+        """Return a list of (command, who) that could happen now.
+
+        "who" is a username, or None if anyone could.
+        """
+        legal = LEGAL_COMMANDS[self.status, self.last_action]
+        return [(command, self._who(who))
+                for command, (who, _) in legal.iteritems()]
+
+    def _who(self, who):
+        """The username a "who" from TRANSITIONS refers to; None for anyone."""
+        if who == 'next':
+            return self.next_player().username
+        elif who == 'last':
+            return self.last_player().username
+        elif who == 'target':
+            return self.last_action_target
+        elif who == 'challenger':
+            return self.challenger
+        elif who == 'challengee':
+            return self._challengee().username
+        else:
+            return None
+
+    def waiting_on(self):
+        winner = self.winner()
+        if winner:
+            return "%s has already won." % winner
+        waiting = ["%s to %s" % (username or 'anyone',
+                                 COMMAND_USAGE[command])
+                   for command, username in self.legal_commands()]
+        if not waiting:
+            return "Nobody can do anything now."
+        return "Waiting on %s." % ', or '.join(waiting)
+
+    def _check_command(self, command, player):
+        """Raise Misplay unless the table lets this player do this now."""
+        legal = LEGAL_COMMANDS[self.status, self.last_action]
+        if command not in legal:
+            raise Misplay("You can't do that right now.  %s"
+                          % self.waiting_on())
+        username = self._who(legal[command][0])
+        if player.is_out():
+            raise Misplay("You're out of the game.")
+        elif username is not None and username != player.username:
+            raise Misplay("It's not up to you.  %s" % self.waiting_on())
+
     def status_view(self, viewer=None):
         lines = [self.status_line()]
         for player in self.players:
             lines.append(player.view(public=(viewer != player)))
         return _join_messages(lines)
 
+    # EXPORT
+
+    def export(self):
+        """A compact dump of the deal and every move since, for replay.py.
+
+        It includes everyone's cards, and the deck, so we only give it out
+        once the game is over.
+        """
+        if not self.winner():
+            raise Misplay("The game isn't over yet, and the export would show "
+                          "everyone's cards.  Try again once someone has "
+                          "won.")
+        elif self.deal is None:
+            raise Misplay("This game started before we kept track of moves, "
+                          "so it can't be exported.")
+        data = {
+            'deal': self.deal,
+            'moves': [[move.username, move.text, move.seed, move.view]
+                      for move in self.moves],
+        }
+        return base64.b64encode(
+            zlib.compress(json.dumps(data, separators=(',', ':')), 9))
+
+    @staticmethod
+    def from_export(game_id, exported):
+        """Returns the game as dealt, and its moves, from export()."""
+        data = json.loads(zlib.decompress(base64.b64decode(exported)))
+        game = GameState._from_deal(game_id, data['deal'])
+        return game, [Move(username=username, text=text, seed=seed, view=view)
+                      for username, text, seed, view in data['moves']]
+
+    def _to_deal(self):
+        return {
+            'players': [[player.username, player.money,
+                         [card.name for card in player.cards]]
+                        for player in self.players],
+            'unused_cards': [card.name for card in self.unused_cards],
+        }
+
+    @staticmethod
+    def _from_deal(game_id, deal):
+        return GameState(
+            id=game_id, status='READY', deal=deal,
+            unused_cards=[Card(name=name, eliminated=False)
+                          for name in deal['unused_cards']],
+            players=[Player(username=username, money=money,
+                            cards=[Card(name=name, eliminated=False)
+                                   for name in cards])
+                     for username, money, cards in deal['players']])
+
     # After calling any of the following, you must then put() self.
     @staticmethod
-    def create(game_id, players):
+    def create(game_id, players, rng=random):
         cards = [Card(name=name, eliminated=False)
                  for name in CARDS for _ in xrange(3)]
-        random.shuffle(cards)
+        rng.shuffle(cards)
         players = [Player(username=player.lstrip('@'), money=2,
                           cards=[cards.pop(), cards.pop()])
                    for player in players]
-        return GameState(id=game_id, status='READY', unused_cards=cards,
+        game = GameState(id=game_id, status='READY', unused_cards=cards,
                          players=players)
+        game.deal = game._to_deal()
+        return game
+
+    def record_move(self, username, text, seed):
+        self.moves.append(Move(username=username, text=text, seed=seed,
+                               view=self.status_view()))
 
     # ACTIONS
 
     def take_action(self, player, action, target):
         # TODO(benkraft): don't let you target yourself.
-        if player != self.next_player():
-            raise Misplay("It's not your turn!  It's %s's turn." %
-                          self.next_player().username)
-        elif not (self.status == 'READY'
-                  or self.status in ('ACTED', 'BLOCKED',
-                                     'CHALLENGE_LOSS_RESOLVED')
-                  and self.last_action not in ACTIONS_WITH_RESPONSE):
-            # TODO(benkraft): say what we're waiting on
-            raise Misplay("It's not time for the next person to go yet!")
-        elif action not in ACTION_NAMES:
+        self._check_command('action', player)
+        if action not in ACTION_NAMES:
             raise Misplay("I've never heard of that action, try one of these: "
                           "%s." % ' '.join(sorted(ACTIONS)))
         action = ACTION_NAMES[action]
+        # Finish up the last action first, since it may change how much money
+        # you have.  (If we then raise Misplay, the caller discards the
+        # game.)
+        flush_text = self._flush_action()
         cost = ACTION_COSTS.get(action, 0)
         if player.money < cost:
             raise Misplay("You don't have enough money to do that; you need "
@@ -262,15 +470,14 @@ class GameState(ndb.Model):
             if action == 'steal' and not target.money:
                 raise Misplay("You can't steal from someone with no money.")
 
-        # Okay, we're ready to act.  Finish up the last action.
-        responses = []
-        responses.append(self._flush_action())
+        # Okay, we're ready to act.
+        responses = [flush_text]
         responses.append(self._begin_action(action, target))
         responses.append(self._maybe_autoresolve_action())
         return _join_messages(responses)
 
     def _flush_action(self):
-        """Cannot be used for ACTIONS_WITH_RESPONSE."""
+        """Cannot be used for ACTIONS_WITH_RESPONSE, unless they're blocked."""
         if not self.last_action:
             # If the last action has been flushed, this is a no-op.
             return
@@ -334,12 +541,20 @@ class GameState(ndb.Model):
             # Don't bother saying it completed, that's obvious.
             self._flush_action()
             return
-        elif self.last_action == 'coup' or (
-                self.last_action == 'assassinate'
-                and self.status == 'BLOCK_CHALLENGE_LOSS_RESOLVED'):
+        elif self.last_action in CARD_LOSS_ACTIONS:
             target = self.get_player(self.last_action_target)
-            if target.one_card():
-                return self._flip_card(target, target.live_cards()[0])
+            if target.is_out():
+                # e.g. they lost their last card to a failed challenge or
+                # block.
+                text = "%s is already out." % target.username
+                self._clear_action()
+                return text
+            elif target.one_card() and (
+                    self.last_action == 'coup'
+                    or self.status == 'BLOCK_CHALLENGE_WON'):
+                text = self._flip_card(target, target.live_cards()[0])
+                self._clear_action()
+                return text
         if self.last_action in CARD_LOSS_ACTIONS:
             return "If you're ready to lose a card, `/coup lose <card>`."
         elif self.last_action == 'exchange':
@@ -352,6 +567,8 @@ class GameState(ndb.Model):
 
     def _flip_card(self, player, card):
         card.eliminated = True
+        if player.is_out():
+            self.eliminated.append(player.username)
         # If this eliminated a player, and it was their turn, advance the turn.
         while self.players[0].is_out():
             self.players = self.players[1:] + [self.players[0]]
@@ -365,7 +582,7 @@ class GameState(ndb.Model):
     def _redeal_card(self, player, card_name):
         c = player.remove_card(card_name)
         self.unused_cards.append(c)
-        random.shuffle(self.unused_cards)
+        self.rng.shuffle(self.unused_cards)
         player.cards.append(self.unused_cards.pop())
         return "%s flipped over a %s and drew a new card." % (
             player.username, card_name)
@@ -375,14 +592,13 @@ class GameState(ndb.Model):
     def pose_challenge(self, challenger):
         # TODO(benkraft): make them say what to challenge, to prevent races?
         # TODO(benkraft): don't let you challenge yourself
-        if self.status == 'ACTED' and self.last_action in ACTION_CARDS:
+        self._check_command('challenge', challenger)
+        if self.status == 'ACTED':
             self.status = 'CHALLENGED'
             verb = self.last_action
-        elif self.status == 'BLOCKED':
+        else:  # self.status == 'BLOCKED'
             self.status = 'BLOCK_CHALLENGED'
             verb = 'block'
-        else:
-            raise Misplay("There's nothing to challenge.")
         self.challenger = challenger.username
         challengee = self._challengee()
 
@@ -397,32 +613,25 @@ class GameState(ndb.Model):
                  % challengee.username])
 
     def resolve_challenge(self, player, card_name):
-        challengee = self._challengee()
-        if (challengee != player
-                or self.status not in ('CHALLENGED', 'BLOCK_CHALLENGED')):
-            raise Misplay("You haven't been challenged.")
-        card = challengee.find_live_card(card_name)
+        self._check_command('show', player)
+        card = player.find_live_card(card_name)
         if not card:
             raise Misplay("You don't have that card.")
 
         return self._resolve_challenge(card)
 
     def lose_challenge(self, player, card_name):
-        challenger = self.get_player(self.challenger)
-        card = challenger.find_live_card(card_name)
-        if player != challenger:
-            # TODO(benkraft): better error message here.
-            raise Misplay("You haven't lost a challenge.")
-        elif self.status not in ('CHALLENGE_LOST',
-                               'BLOCK_CHALLENGE_LOST'):
-            raise Misplay("You haven't lost a challenge.")
-        elif not card:
+        self._check_command('flip', player)
+        card = player.find_live_card(card_name)
+        if not card:
             raise Misplay("You don't have that card.")
 
-        text = self._flip_card(challenger, card)
+        text = self._flip_card(player, card)
         if self.status == 'CHALLENGE_LOST':
             self.status = 'CHALLENGE_LOSS_RESOLVED'
-            if self.last_action in ACTION_BLOCKS:
+            target = self.get_player(self.last_action_target)
+            if (self.last_action in ACTION_BLOCKS
+                    and not (target and target.is_out())):
                 return _join_messages([text, "If you wish to block, "
                                        "`/coup block <with_card>`."])
             else:
@@ -436,7 +645,9 @@ class GameState(ndb.Model):
 
     def _challengee(self):
         if self.status == 'CHALLENGED':
-            return self.players[-1]
+            # Not players[-1]: players who are out get rotated past the one
+            # who acted.
+            return self.last_player()
         else:
             return self.get_player(self.blocker)
 
@@ -453,7 +664,7 @@ class GameState(ndb.Model):
                 if challenger.one_card():
                     return _join_messages(
                         [redeal_text, self.lose_challenge(
-                            challenger, challenger.live_cards()[0])])
+                            challenger, challenger.live_cards()[0].name)])
                 else:
                     return _join_messages([redeal_text, flip_card_text])
             else:
@@ -468,7 +679,7 @@ class GameState(ndb.Model):
                 if challenger.one_card():
                     return _join_messages(
                         [redeal_text, self.lose_challenge(
-                            challenger, challenger.live_cards()[0])])
+                            challenger, challenger.live_cards()[0].name)])
                 else:
                     return _join_messages([redeal_text, flip_card_text])
             else:
@@ -482,18 +693,13 @@ class GameState(ndb.Model):
 
     def pose_block(self, blocker, card_name):
         # TODO(benkraft): guess card if it's unique
-        if self.status not in ('ACTED', 'CHALLENGE_LOSS_RESOLVED'):
-            raise Misplay("You can't block right now.")
-        elif self.last_action not in ACTION_BLOCKS:
+        if self.last_action and self.last_action not in ACTION_BLOCKS:
             raise Misplay("%s can't be blocked." % self.last_action)
-        elif self.last_player() == blocker:
-            raise Misplay("You can't block yourself.")
         # Foreign aid can be blocked by anyone; steal and assassinate can only
-        # be blocked by their targets.
-        elif (self.last_action != 'foreignaid'
-              and self.last_action_target != blocker.username):
-            raise Misplay("Only the target of a %s can block it."
-                          % self.last_action)
+        # be blocked by their targets.  The table knows that.
+        self._check_command('block', blocker)
+        if self.last_player() == blocker:
+            raise Misplay("You can't block yourself.")
         elif card_name not in ACTION_BLOCKS[self.last_action]:
             raise Misplay("You can't block %s with a %s."
                           % (self.last_action, card_name))
@@ -509,17 +715,11 @@ class GameState(ndb.Model):
     # AMBASSADOR
 
     def take_cards(self, player):
-        # TODO(benkraft): this might not be true, if the state is READY
-        if player != self.last_player():
-            raise Misplay("It's not your turn.")
-        elif self.last_action != 'exchange':
+        if self.last_action != 'exchange':
             raise Misplay("You didn't exchange.")
-        elif self.status not in ('ACTED', 'CHALLENGE_LOSS_RESOLVED',
-                                 'BLOCK_CHALLENGE_WON'):
-            # TODO(benkraft): say why
-            raise Misplay("You can't take your cards right now.")
+        self._check_command('exchange', player)
         self.status = 'CARDS_TAKEN'
-        random.shuffle(self.unused_cards)
+        self.rng.shuffle(self.unused_cards)
         card1 = self.unused_cards.pop()
         card2 = self.unused_cards.pop()
         player.cards.extend([card1, card2])
@@ -527,22 +727,17 @@ class GameState(ndb.Model):
                 "`/coup return <card1> <card2>`." % (card1.name, card2.name))
 
     def return_cards(self, player, card1_name, card2_name):
-        # TODO(benkraft): this might not be true, if the state is READY
-        if player != self.last_player():
-            raise Misplay("It's not your turn.")
-        elif self.last_action != 'exchange':
+        if self.last_action != 'exchange':
             raise Misplay("You didn't exchange.")
-        elif self.status != 'CARDS_TAKEN':
-            raise Misplay("You didn't take cards!  "
-                          "To take cards, `/coup take`.")
-        elif (card1_name == card2_name
+        self._check_command('return', player)
+        if (card1_name == card2_name
               and not player.live_card_names().count(card1_name) >= 2):
             raise Misplay("You don't have two %ss." % card1_name)
         for card in [card1_name, card2_name]:
             if not player.find_live_card(card):
                 raise Misplay("You don't have a %s." % card)
         for card in [card1_name, card2_name]:
-            player.remove_card(card)
+            self.unused_cards.append(player.remove_card(card))
         self._clear_action()
         return "%s returned their cards." % player.username
 
@@ -551,15 +746,75 @@ class GameState(ndb.Model):
     def lose_card(self, player, card_name):
         if self.last_action not in CARD_LOSS_ACTIONS:
             raise Misplay("You don't need to lose a card now.")
-        elif player.username != self.last_action_target:
-            raise Misplay("You weren't the target of the %s."
-                          % self.last_action)
-        elif self.status not in ('ACTED', 'CHALLENGE_LOSS_RESOLVED',
-                                 'BLOCK_CHALLENGE_WON'):
-            raise Misplay("It's not time to flip a card yet.")
+        self._check_command('lose', player)
         card = player.find_live_card(card_name)
         if not card:
             raise Misplay("You don't have a %s." % card_name)
         text = self._flip_card(player, card)
         self._clear_action()
         return text
+
+    # FORFEITING
+
+    def forfeit(self, player):
+        """Flip all the player's cards, whatever's going on.
+
+        If we were waiting on them to flip or lose a card, the first card
+        counts for that.  If we were waiting on them for anything else, we drop
+        their challenge or block, or their action, so that the game can go on.
+        Anything that didn't depend on them goes on as it was.
+        """
+        winner = self.winner()
+        if winner:
+            raise Misplay("%s has already won." % winner)
+        elif player.is_out():
+            raise Misplay("You're out of the game.")
+        responses = ["%s forfeited." % player.username]
+        waiting = [command for command, username in self.legal_commands()
+                   if username == player.username]
+        if 'flip' in waiting:
+            responses.append(self.lose_challenge(
+                player, player.live_cards()[0].name))
+        elif 'lose' in waiting:
+            responses.append(self.lose_card(
+                player, player.live_cards()[0].name))
+
+        dropped = None
+        if self.winner() or not self.last_action:
+            pass
+        elif (self.status in ('CHALLENGED', 'BLOCK_CHALLENGED')
+              and self.challenger == player.username):
+            dropped = 'challenge'
+        elif (self.status in ('BLOCKED', 'BLOCK_CHALLENGED')
+              and self.blocker == player.username):
+            dropped = 'block'
+        elif (player == self.last_player()
+              and 'action' not in LEGAL_COMMANDS[self.status,
+                                                 self.last_action]):
+            dropped = 'action'
+            if self.status == 'CARDS_TAKEN':
+                # Put back the cards they drew, which are the last two.
+                self.unused_cards.extend(player.cards[-2:])
+                del player.cards[-2:]
+
+        for card in player.live_cards():
+            responses.append(self._flip_card(player, card))
+        if self.winner():
+            if dropped == 'action':
+                self._clear_action()
+            return _join_messages(responses)
+        elif dropped == 'challenge':
+            self.status = ('ACTED' if self.status == 'CHALLENGED'
+                           else 'BLOCKED')
+            responses.append("%s's challenge was dropped." % player.username)
+        elif dropped == 'block':
+            # As if the block had been challenged successfully.
+            self.status = 'BLOCK_CHALLENGE_WON'
+            responses.extend(["%s's block was dropped." % player.username,
+                              self._maybe_autoresolve_action(
+                                  block_complete=True)])
+        elif dropped == 'action':
+            responses.append("%s's %s was abandoned." % (
+                player.username, self.last_action))
+            self._clear_action()
+        return _join_messages(responses)
@@ -0,0 +1,488 @@
+"""Randomized and exhaustive state-space fuzzer for the rule engine.
+
+Plays games through coup.run_command, exactly as the slash command would, and
+checks invariants after every accepted command:
+    - all 15 cards are accounted for, 3 of each
+    - every player holds 2 cards (4 for the exchanger, while choosing)
+    - nobody has negative money
+    - the status is one we know about, and status_view() renders it
+    - the command was legal, and led to a status, according to TRANSITIONS
+    - there's never less than one player left in the game
+    - everyone who's out is recorded as eliminated, exactly once
+    - until somebody has won, someone can always move the game along, not
+      just challenge or block
+Commands that raise Misplay are rejected and the game is rolled back, since the
+handler doesn't put() the game in that case; any other exception is a failure.
+
+By default, plays random games.  With --explore, does a breadth-first search of
+the states reachable from each deal instead, pruning states it has already
+seen (up to the order of the deck).  Either way, we only try the commands
+TRANSITIONS allows.  Failing command sequences are shrunk before they're
+reported.
+
+This runs at a few thousand commands a second, which is around a hundred
+games (and not thousands): every command goes through run_command and real
+ndb models, because that's the code we want to test.
+
+Needs the App Engine SDK on the PYTHONPATH (for ndb and webapp2), but not a
+datastore: games are never put().
+
+    python fuzz.py [--games N] [--seed S] [--players N] [--explore]
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import itertools
+import random
+import sys
+import time
+
+import coup
+import engine
+
+
+GAME_ID = 'fuzz#fuzz'
+
+# Commands nobody has to make; if they're all that's left, we're stuck.
+OPTIONAL_COMMANDS = {'challenge', 'block'}
+
+# How often to try an optional command before the ones that move things along.
+OPTIONAL_CHANCE = 0.3
+
+
+class Failure(Exception):
+    """An invariant was violated.
+
+    `signature` identifies the failure well enough to deduplicate and shrink
+    it: the kind of failure, and the status and command it happened on.
+    """
+    def __init__(self, kind, message, status=None, verb=None):
+        super(Failure, self).__init__(
+            '%s in %s after %s: %s' % (kind, status, verb, message))
+        self.signature = (kind, status, verb)
+
+
+# SNAPSHOTS
+
+def _card_tuple(card):
+    return (card.name, bool(card.eliminated))
+
+
+def _snapshot(game):
+    """Everything the engine looks at, as a hashable tuple."""
+    return (
+        game.status, game.last_action, game.last_action_target,
+        game.challenger, game.blocker, game.blocked_with,
+        tuple(_card_tuple(card) for card in game.unused_cards),
+        tuple((player.username, player.money,
+               tuple(_card_tuple(card) for card in player.cards))
+              for player in game.players),
+        tuple(game.eliminated),
+    )
+
+
+def _canonical(snapshot):
+    """Identifies states that differ only in the order of the deck.
+
+    The deck gets shuffled before every draw, so its order never matters.
+    """
+    return snapshot[:6] + (tuple(sorted(snapshot[6])),) + snapshot[7:]
+
+
+def _restore(snapshot):
+    (status, last_action, last_action_target, challenger, blocker,
+     blocked_with, unused_cards, players, eliminated) = snapshot
+    return engine.GameState(
+        status=status, last_action=last_action,
+        last_action_target=last_action_target, challenger=challenger,
+        blocker=blocker, blocked_with=blocked_with,
+        unused_cards=[engine.Card(name=name, eliminated=dead)
+                      for name, dead in unused_cards],
+        players=[engine.Player(username=username, money=money,
+                               cards=[engine.Card(name=name, eliminated=dead)
+                                      for name, dead in cards])
+                 for username, money, cards in players],
+        eliminated=list(eliminated))
+
+
+# PLAYING
+
+def _deal(seed, num_players):
+    return engine.GameState.create(
+        None, ['p%s' % i for i in xrange(1, num_players + 1)],
+        random.Random(seed))
+
+
+def _step_seed(seed, step):
+    # Each command gets its own seed, keyed on the step it was first made at,
+    # so that a trace replays the same way no matter how many rejected
+    # commands were tried in between, or how many earlier commands the
+    # shrinker has removed.
+    return seed * 1000003 + step
+
+
+def _candidate_commands(game):
+    """The commands TRANSITIONS allows now, as (username, args) pairs.
+
+    Only the players the table names make them, with cards they have; they may
+    still be rejected, e.g. for want of money.
+    """
+    usernames = game.player_usernames()
+    commands = []
+    for command, who in game.legal_commands():
+        for username in ([who] if who else usernames):
+            player = game.get_player(username)
+            if player is None or player.is_out():
+                continue
+            live_cards = sorted(set(player.live_card_names()))
+            if command == 'action':
+                for action in sorted(engine.ACTIONS):
+                    if action not in engine.ACTIONS_WITH_TARGETS:
+                        commands.append((username, ('action', action)))
+                        continue
+                    for target in usernames:
+                        if target != username:
+                            commands.append(
+                                (username, ('action', action, target)))
+            elif command == 'block':
+                for card in sorted(engine.ACTION_BLOCKS[game.last_action]):
+                    commands.append((username, ('block', card)))
+            elif command in ('show', 'flip', 'lose'):
+                for card in live_cards:
+                    commands.append((username, (command, card)))
+            elif command == 'return':
+                for pair in itertools.combinations_with_replacement(
+                        live_cards, 2):
+                    commands.append((username, ('return',) + pair))
+            else:
+                commands.append((username, (command,)))
+    return commands
+
+
+def _split_optional(commands):
+    """Split commands into those that move the game along, and the rest."""
+    required = [command for command in commands
+                if command[1][0] not in OPTIONAL_COMMANDS]
+    optional = [command for command in commands
+                if command[1][0] in OPTIONAL_COMMANDS]
+    return required, optional
+
+
+def _check_invariants(game, verb):
+    def fail(kind, message):
+        raise Failure(kind, message, game.status, verb)
+
+    if game.status not in engine.STATUSES:
+        fail('unknown status', game.status)
+    if not game.remaining_players():
+        fail('no winner', 'every player is out')
+    out = [player.username for player in game.players if player.is_out()]
+    if sorted(out) != sorted(game.eliminated):
+        fail('elimination order', '%s are out, but we recorded %s'
+             % (out, game.eliminated))
+
+    cards = list(game.unused_cards)
+    for player in game.players:
+        cards.extend(player.cards)
+        if player.money < 0:
+            fail('negative money', '%s has %s' % (player.username,
+                                                  player.money))
+        hand = 2
+        if (game.status == 'CARDS_TAKEN'
+                and player.username == game.last_player().username):
+            hand = 4
+        if len(player.cards) != hand:
+            fail('hand size', '%s has %s cards' % (player.username,
+                                                   len(player.cards)))
+    counts = collections.Counter(card.name for card in cards)
+    if len(cards) != 15 or any(counts[name] != 3 for name in engine.CARDS):
+        fail('cards not conserved', ', '.join(
+            '%s %s' % (counts[name], name) for name in sorted(engine.CARDS)))
+
+    try:
+        game.status_view()
+    except Exception as e:
+        fail('render', '%s: %s' % (type(e).__name__, e))
+
+
+def _step(game, username, args, seed):
+    """Run one command.
+
+    Returns (game, accepted).  Rejected commands leave the game as it was.
+    Raises Failure if the command broke something, in which case the game may
+    be left in any state.
+    """
+    before = _snapshot(game)
+    try:
+        coup.run_command(game, GAME_ID, username, list(args),
+                         random.Random(seed))
+    except engine.Misplay:
+        if _snapshot(game) != before:
+            game = _restore(before)
+        return game, False
+    except Exception as e:
+        raise Failure('exception', '%s: %s' % (type(e).__name__, e),
+                      before[0], args[0])
+    legal = engine.LEGAL_COMMANDS[before[0], before[1]]
+    if args[0] not in legal or game.status not in legal[args[0]][1]:
+        raise Failure('undeclared transition', 'ended up in %s' % game.status,
+                      before[0], args[0])
+    _check_invariants(game, args[0])
+    return game, True
+
+
+def _stuck(game):
+    return Failure('stuck', 'nobody can move the game along', game.status,
+                   game.last_action)
+
+
+def _check_stuck(game, seed, step):
+    """Raise Failure if nobody has won, and nobody can move things along.
+
+    It doesn't count if all anyone can do is challenge or block: nobody has
+    to, so the game could sit there forever.
+    """
+    if game.winner():
+        return
+    stuck = _stuck(game)
+    required, _ = _split_optional(_candidate_commands(game))
+    for username, args in required:
+        try:
+            game, accepted = _step(game, username, args,
+                                   _step_seed(seed, step))
+        except Failure:
+            accepted = True
+        if accepted:
+            return
+    raise stuck
+
+
+def _replay(seed, num_players, trace):
+    """Play a trace from the deal; return the Failure it hits, if any."""
+    game = _deal(seed, num_players)
+    try:
+        for step, username, args in trace:
+            game, _ = _step(game, username, args, _step_seed(seed, step))
+        _check_stuck(game, seed, trace[-1][0] + 1 if trace else 0)
+    except Failure as e:
+        return e
+    return None
+
+
+def shrink(seed, num_players, trace, signature):
+    """Remove as much of the trace as we can while it still fails the same."""
+    trace = list(trace)
+    chunk = len(trace) // 2
+    while chunk >= 1:
+        i = 0
+        while i < len(trace):
+            candidate = trace[:i] + trace[i + chunk:]
+            failure = _replay(seed, num_players, candidate)
+            if failure and failure.signature == signature:
+                trace = candidate
+            else:
+                i += chunk
+        chunk //= 2
+    return trace
+
+
+class Fuzzer(object):
+    def __init__(self, max_steps):
+        self.max_steps = max_steps
+        self.games = 0
+        self.unfinished = 0
+        self.abandoned = 0
+        self.commands = 0
+        self.states = 0
+        # (status, verb) -> number of times accepted
+        self.transitions = collections.Counter()
+        self.statuses = collections.Counter()
+        # signature -> [count, seed, num_players, trace, message]
+        self.failures = {}
+
+    def _record(self, failure, seed, num_players, trace):
+        entry = self.failures.get(failure.signature)
+        if entry is None:
+            self.failures[failure.signature] = [
+                1, seed, num_players, trace, str(failure)]
+        else:
+            entry[0] += 1
+            if len(trace) < len(entry[3]):
+                entry[1:] = [seed, num_players, trace, str(failure)]
+
+    def _accepted(self, status, verb, game):
+        self.commands += 1
+        self.transitions[status, verb] += 1
+        self.statuses[game.status] += 1
+
+    def play(self, seed, num_players):
+        """Play one random game."""
+        self.games += 1
+        game = _deal(seed, num_players)
+        self.statuses[game.status] += 1
+        trace = []
+        rng = random.Random(seed)
+        while not game.winner():
+            if len(trace) >= self.max_steps:
+                self.unfinished += 1
+                return
+            step = len(trace)
+            required, optional = _split_optional(_candidate_commands(game))
+            if not required:
+                self._record(_stuck(game), seed, num_players, trace)
+                return
+            rng.shuffle(required)
+            rng.shuffle(optional)
+            optional_first = rng.random() < OPTIONAL_CHANCE
+            if optional_first:
+                candidates = optional + required
+            else:
+                candidates = required + optional
+            before = _snapshot(game)
+            failed = False
+            for username, args in candidates:
+                try:
+                    game, accepted = _step(game, username, args,
+                                           _step_seed(seed, step))
+                except Failure as e:
+                    # Keep playing from the last good state, as if the
+                    # command had been rejected.
+                    self._record(e, seed, num_players,
+                                 trace + [(step, username, args)])
+                    game = _restore(before)
+                    failed = True
+                    continue
+                if accepted:
+                    break
+            else:
+                if failed:
+                    self.abandoned += 1
+                else:
+                    self._record(_stuck(game), seed, num_players, trace)
+                return
+            if (not optional_first and args[0] in OPTIONAL_COMMANDS
+                    and not failed):
+                # Everything that would have moved the game along was
+                # rejected.
+                self._record(_stuck(_restore(before)), seed, num_players,
+                             trace)
+                return
+            self._accepted(before[0], args[0], game)
+            trace.append((step, username, args))
+
+    def explore(self, seed, num_players, max_states):
+        """Search the states reachable from one deal, breadth-first."""
+        self.games += 1
+        game = _deal(seed, num_players)
+        start = _snapshot(game)
+        seen = {_canonical(start)}
+        queue = collections.deque([(start, [])])
+        self.statuses[game.status] += 1
+        while queue and len(seen) < max_states:
+            snapshot, trace = queue.popleft()
+            game = _restore(snapshot)
+            if game.winner():
+                continue
+            step = len(trace)
+            can_progress = False
+            for username, args in _candidate_commands(game):
+                command_trace = trace + [(step, username, args)]
+                try:
+                    game, accepted = _step(game, username, args,
+                                           _step_seed(seed, step))
+                except Failure as e:
+                    self._record(e, seed, num_players, command_trace)
+                    can_progress = True
+                    game = _restore(snapshot)
+                    continue
+                if not accepted:
+                    continue
+                if args[0] not in OPTIONAL_COMMANDS:
+                    can_progress = True
+                self._accepted(snapshot[0], args[0], game)
+                after = _snapshot(game)
+                key = _canonical(after)
+                if key not in seen:
+                    seen.add(key)
+                    queue.append((after, command_trace))
+                game = _restore(snapshot)
+            if not can_progress:
+                self._record(_stuck(_restore(snapshot)), seed, num_players,
+                             trace)
+        self.states += len(seen)
+
+    def report(self, elapsed):
+        print("%s games, %s commands in %.1fs: %.0f games/s, %.0f "
+              "commands/s" % (self.games, self.commands, elapsed,
+                              self.games / elapsed,
+                              self.commands / elapsed))
+        if self.states:
+            print("%s distinct states explored" % self.states)
+        if self.unfinished:
+            print("%s games hit the step limit" % self.unfinished)
+        if self.abandoned:
+            print("%s games abandoned after every legal command failed"
+                  % self.abandoned)
+
+        print("\nCoverage:")
+        for status in engine.STATUSES:
+            verbs = {verb for (from_status, verb) in self.transitions
+                     if from_status == status}
+            declared = {command for (from_status, command, _, _, _)
+                        in engine.TRANSITIONS if from_status == status}
+            if status not in self.statuses:
+                print("  %s: never reached" % status)
+            else:
+                print("  %s: reached %s times; accepted %s" % (
+                    status, self.statuses[status],
+                    ' '.join(sorted(verbs)) or 'nothing'))
+            if declared - verbs:
+                print("    never accepted: %s"
+                      % ' '.join(sorted(declared - verbs)))
+
+        if not self.failures:
+            print("\nNo failures.")
+            return
+        print("\n%s distinct failures:" % len(self.failures))
+        for signature, (count, seed, num_players, trace, message) in sorted(
+                self.failures.items()):
+            trace = shrink(seed, num_players, trace, signature)
+            print("\n%s (%s times)" % (message, count))
+            print("  seed %s, %s players:" % (seed, num_players))
+            for _, username, args in trace:
+                print("    %s: /coup %s" % (username, ' '.join(args)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--games', type=int, default=1000,
+                        help="number of games (or deals, with --explore)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed for the first game; the rest follow it")
+    parser.add_argument('--players', type=int, default=0,
+                        help="players per game (default: random 3-6)")
+    parser.add_argument('--max-steps', type=int, default=500,
+                        help="give up on random games after this many "
+                        "commands")
+    parser.add_argument('--explore', action='store_true',
+                        help="search reachable states instead of playing "
+                        "random games")
+    parser.add_argument('--max-states', type=int, default=10000,
+                        help="states to explore per deal, with --explore")
+    args = parser.parse_args(argv)
+
+    fuzzer = Fuzzer(args.max_steps)
+    start = time.time()
+    for seed in xrange(args.seed, args.seed + args.games):
+        num_players = args.players or random.Random(seed).randint(3, 6)
+        if args.explore:
+            fuzzer.explore(seed, num_players, args.max_states)
+        else:
+            fuzzer.play(seed, num_players)
+    fuzzer.report(max(time.time() - start, 1e-6))
+    return 1 if fuzzer.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,142 @@
+"""Check that flooding Slack with commands doesn't slow down real players.
+
+Deals a game, then has flooders send commands as fast as they can while the
+players send one every so often, and reports how many of the flood commands
+were rate limited, and how long the players' commands took.  There are three
+floods, one for each rate limit that should protect the players from it:
+- one user in the players' channel (the per-user limit),
+- many users in another channel of the players' team (the per-channel limit),
+- many users in many channels of another team (the per-team limit).
+
+Run it against the dev server (`make serve`):
+
+    python loadtest.py [--url URL] [--duration SECONDS] [--flooders N]
+                       [--flood-users N]
+
+If SLACK_SIGNING_SECRET is set, signs requests with it.  Needs the App Engine
+SDK on the PYTHONPATH, for ratelimit.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import hashlib
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+import urllib
+import urllib2
+
+import ratelimit
+
+
+TEAM_ID = 'Tloadtest'
+CHANNEL_ID = 'Cloadtest'
+FLOOD_CHANNEL_ID = 'Cflood'
+FLOOD_TEAM_ID = 'Tflood'
+PLAYERS = ['p1', 'p2', 'p3']
+
+
+def send(url, username, text, team_id=TEAM_ID, channel_id=CHANNEL_ID):
+    """Send a command; return (seconds taken, whether we were rate limited)."""
+    body = urllib.urlencode({
+        'team_id': team_id,
+        'channel_id': channel_id,
+        'user_id': 'U%s' % username,
+        'user_name': username,
+        'text': text,
+    })
+    headers = {}
+    signing_secret = os.environ.get('SLACK_SIGNING_SECRET')
+    if signing_secret:
+        timestamp = str(int(time.time()))
+        headers['X-Slack-Request-Timestamp'] = timestamp
+        headers['X-Slack-Signature'] = 'v0=' + hmac.new(
+            signing_secret, 'v0:%s:%s' % (timestamp, body),
+            hashlib.sha256).hexdigest()
+    start = time.time()
+    response = urllib2.urlopen(urllib2.Request(url, body, headers)).read()
+    elapsed = time.time() - start
+    return elapsed, json.loads(response)['text'] == ratelimit.MESSAGE
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://localhost:8090/')
+    parser.add_argument('--duration', type=float, default=10,
+                        help="seconds to run for")
+    parser.add_argument('--flooders', type=int, default=2,
+                        help="threads sending commands as fast as they can, "
+                             "for each flood")
+    parser.add_argument('--flood-users', type=int, default=50,
+                        help="distinct users (and, for the per-team flood, "
+                             "channels) to flood from")
+    parser.add_argument('--interval', type=float, default=2,
+                        help="seconds between each player's commands")
+    args = parser.parse_args(argv)
+
+    send(args.url, PLAYERS[0], 'restart %s' % ' '.join(PLAYERS))
+    deadline = time.time() + args.duration
+    # dict from flood to a list of results; lists are safe to append to from
+    # several threads.
+    flood_results = collections.OrderedDict([
+        ('user', []), ('channel', []), ('team', [])])
+    player_results = []
+
+    def flood(kind, thread_index):
+        i = thread_index
+        while time.time() < deadline:
+            i += args.flooders
+            flooder = 'flooder%s' % (i % args.flood_users)
+            if kind == 'user':
+                result = send(args.url, 'flooder', 'status')
+            elif kind == 'channel':
+                result = send(args.url, flooder, 'status',
+                              channel_id=FLOOD_CHANNEL_ID)
+            else:
+                result = send(args.url, flooder, 'status',
+                              team_id=FLOOD_TEAM_ID,
+                              channel_id='C%s' % flooder)
+            flood_results[kind].append(result)
+
+    def play(username):
+        while time.time() < deadline:
+            player_results.append(send(args.url, username, 'status'))
+            time.sleep(args.interval)
+
+    threads = ([threading.Thread(target=flood, args=(kind, i))
+                for kind in flood_results
+                for i in xrange(args.flooders)] +
+               [threading.Thread(target=play, args=(username,))
+                for username in PLAYERS])
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for kind, results in flood_results.iteritems():
+        flood_limited = sum(1 for _, limited in results if limited)
+        print("Per-%s flood: %s commands, %s rate limited" % (
+            kind, len(results), flood_limited))
+    latencies = [elapsed for elapsed, _ in player_results]
+    player_limited = sum(1 for _, limited in player_results if limited)
+    print("Players: %s commands, %s rate limited" % (len(player_results),
+                                                      player_limited))
+    if latencies:
+        print("Player latency: p50 %.0fms, p95 %.0fms, max %.0fms" % (
+            _percentile(latencies, 0.5) * 1000,
+            _percentile(latencies, 0.95) * 1000,
+            max(latencies) * 1000))
+    return 1 if player_limited else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
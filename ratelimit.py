@@ -0,0 +1,120 @@
+"""Per-team, per-channel, and per-user rate limiting for the slash command.
+
+Each of those gets a token bucket; a command needs a token from all three.
+By default the buckets live in memory, per instance; set RATE_LIMIT_BACKEND to
+'memcache' in app.yaml to share (approximate) counts between instances.
+"""
+import collections
+import logging
+import os
+import time
+
+from google.appengine.api import memcache
+
+
+# dict from scope to (bucket size, tokens added per second).  We check the
+# most specific scope first, so that someone flooding a channel runs out of
+# their own tokens before they use up everyone else's.
+LIMITS = collections.OrderedDict([
+    ('user', (10, 1.0)),
+    ('channel', (30, 3.0)),
+    ('team', (100, 10.0)),
+])
+
+MESSAGE = "Slow down!  You're sending commands too fast; try again shortly."
+
+# When we have this many in-memory buckets, forget the ones that are full.
+MAX_BUCKETS = 10000
+
+# dict from scope to number of commands rejected in it, on this instance.
+HITS = collections.Counter()
+
+
+class TokenBucket(object):
+    def __init__(self, capacity, rate, now):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class MemoryBackend(object):
+    """Token buckets in this instance's memory."""
+    def __init__(self):
+        self.buckets = {}
+
+    def take(self, key, capacity, rate, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= MAX_BUCKETS:
+                self._prune(now)
+            bucket = self.buckets[key] = TokenBucket(capacity, rate, now)
+        return bucket.take(now)
+
+    def _prune(self, now):
+        for key, bucket in self.buckets.items():
+            if bucket.is_full(now):
+                del self.buckets[key]
+
+
+class MemcacheBackend(object):
+    """Counters in memcache, shared between instances.
+
+    Memcache can't do a token bucket atomically, so we approximate one with a
+    fixed window: `capacity` commands per `capacity / rate` seconds.  If
+    memcache is down, we let everything through.
+    """
+    def take(self, key, capacity, rate, now):
+        window = max(1, int(capacity / rate))
+        key = 'ratelimit:%s:%s' % (key, int(now // window))
+        # incr doesn't take an expiry, so add the counter first; this does
+        # nothing if it's already there.
+        memcache.add(key, 0, time=window * 2)
+        count = memcache.incr(key, initial_value=0)
+        return count is None or count <= capacity
+
+
+def _make_backend():
+    if os.environ.get('RATE_LIMIT_BACKEND') == 'memcache':
+        return MemcacheBackend()
+    return MemoryBackend()
+
+
+_backend = _make_backend()
+
+
+def check(team_id, channel_id, user_id, now=None):
+    """Take a token for a command; return the scope that's out, or None."""
+    if now is None:
+        now = time.time()
+    keys = {
+        'user': '%s#%s' % (team_id, user_id),
+        'channel': '%s#%s' % (team_id, channel_id),
+        'team': team_id,
+    }
+    for scope, (capacity, rate) in LIMITS.iteritems():
+        if not _backend.take('%s:%s' % (scope, keys[scope]), capacity, rate,
+                             now):
+            HITS[scope] += 1
+            # Logged in a fixed format so it can be turned into a log-based
+            # metric.
+            logging.warning("Rate limited: scope=%s key=%s total=%s",
+                            scope, keys[scope], HITS[scope])
+            return scope
+    return None
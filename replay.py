@@ -0,0 +1,81 @@
+"""Replay games from `/coup export`, as a regression test and benchmark.
+
+Runs each game's moves through coup.run_command as fast as it can, checking
+that status_view() after each one matches what was recorded, and reports any
+differences along with how fast it went.  Give it files containing the
+exported games, one per file; by default, replays everything in corpus/.
+
+Needs the App Engine SDK on the PYTHONPATH (for ndb and webapp2), but not a
+datastore: games are never put().
+
+    python replay.py [FILE ...]
+"""
+from __future__ import print_function
+
+import difflib
+import glob
+import random
+import sys
+import time
+
+import coup
+import engine
+
+
+GAME_ID = 'replay#replay'
+
+
+def replay(exported):
+    """Replay a game; return (number of moves replayed, a diff or None)."""
+    game, moves = engine.GameState.from_export(GAME_ID, exported)
+    for i, move in enumerate(moves):
+        try:
+            coup.run_command(game, GAME_ID, move.username, move.text.split(),
+                             random.Random(move.seed))
+        except engine.Misplay as e:
+            view = "Misplay: %s" % e
+        else:
+            view = game.status_view()
+        if view != move.view:
+            diff = difflib.unified_diff(
+                move.view.splitlines(), view.splitlines(),
+                'recorded', 'replayed', lineterm='')
+            return i + 1, "After move %s (%s: /coup %s):\n%s" % (
+                i + 1, move.username, move.text, '\n'.join(diff))
+    return len(moves), None
+
+
+def main(argv):
+    filenames = argv or sorted(glob.glob('corpus/*'))
+    if not filenames:
+        print("No games to replay.")
+        return 1
+
+    failures = 0
+    total_bytes = 0
+    total_moves = 0
+    elapsed = 0
+    for filename in filenames:
+        with open(filename) as f:
+            # Allow the ``` Slack puts around the export, if it got copied.
+            exported = f.read().strip().strip('`')
+        total_bytes += len(exported)
+        start = time.time()
+        num_moves, diff = replay(exported)
+        elapsed += time.time() - start
+        total_moves += num_moves
+        if diff:
+            failures += 1
+            print((u"%s differs from its recording.  %s\n"
+                   % (filename, diff)).encode('utf-8'))
+
+    print("%s games, %s moves in %.2fs: %.0f moves/s, %.0f bytes/game" % (
+        len(filenames), total_moves, elapsed,
+        total_moves / max(elapsed, 1e-6), total_bytes / len(filenames)))
+    if failures:
+        print("%s games differed." % failures)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
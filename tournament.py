@@ -0,0 +1,193 @@
+import random
+
+from google.appengine.ext import ndb
+
+import engine
+
+
+MIN_TABLE_SIZE = 3
+MAX_TABLE_SIZE = 6
+
+
+def _ordinal(n):
+    return '%s%s' % (n, {1: 'st', 2: 'nd', 3: 'rd'}.get(n, 'th'))
+
+
+def seat_players(usernames):
+    """Split players into tables of 3-6.
+
+    Uses as few tables as we can, with sizes as even as we can make them, and
+    seats players at random.
+    """
+    usernames = list(usernames)
+    random.shuffle(usernames)
+    num_tables = -(-len(usernames) // MAX_TABLE_SIZE)
+    return [usernames[i::num_tables] for i in xrange(num_tables)]
+
+
+class Table(ndb.Model):
+    """StructuredProperty on Tournament."""
+    game_id = ndb.StringProperty()
+    usernames = ndb.StringProperty(repeated=True)
+    finished = ndb.BooleanProperty()
+
+
+class Standing(ndb.Model):
+    """StructuredProperty on Tournament."""
+    username = ndb.StringProperty()
+    # The last round they played in.
+    round = ndb.IntegerProperty()
+    # Where they placed at their table in that round; 1 means they won.  None
+    # if they're still playing.
+    place = ndb.IntegerProperty(required=False)
+    # The game ID of their table in that round
+    game_id = ndb.StringProperty(required=False)
+
+
+class Tournament(ndb.Model):
+    """Per-channel singleton to store a tournament.
+
+    Keyed on "team_id#channel_id", like GameState.  Each table is its own
+    GameState, keyed on "team_id#channel_id#nonce#round#table", so that the
+    tables can play at the same time without contending with each other; we
+    only touch the Tournament when a table finishes.
+    """
+    # Random, so that a new tournament's tables never have the same keys as
+    # an old one's in the same channel.
+    nonce = ndb.StringProperty()
+    round = ndb.IntegerProperty()
+    # This round's tables
+    tables = ndb.LocalStructuredProperty(Table, repeated=True)
+    # Every round's tables' game IDs, so we can clean them up
+    game_ids = ndb.StringProperty(repeated=True)
+    standings = ndb.LocalStructuredProperty(Standing, repeated=True)
+    winner = ndb.StringProperty(required=False)
+    last_timestamp = ndb.DateTimeProperty(auto_now=True)
+
+    def get_standing(self, username):
+        for standing in self.standings:
+            if standing.username == username:
+                return standing
+        return None
+
+    def table_for(self, username):
+        """The game ID of the table the player is playing at, if any."""
+        for table in self.tables:
+            if not table.finished and username in table.usernames:
+                return table.game_id
+        return None
+
+    def last_table_for(self, username):
+        """The game ID of the last table the player played at, if any."""
+        standing = self.get_standing(username)
+        return standing and standing.game_id
+
+    def standings_view(self):
+        if self.winner:
+            lines = ["*%s has won the tournament!*" % self.winner]
+        else:
+            lines = ["Round %s of the tournament." % self.round]
+        standings = sorted(self.standings, key=lambda standing: (
+            -standing.round, standing.place or 0, standing.username))
+        for standing in standings:
+            if standing.place is None:
+                result = "playing in round %s" % standing.round
+            elif standing.username == self.winner:
+                result = "won round %s" % standing.round
+            else:
+                result = "%s at their table in round %s" % (
+                    _ordinal(standing.place), standing.round)
+            lines.append("%s: %s" % (standing.username, result))
+        return '\n'.join(lines)
+
+    # After calling any of the following, you must then put() self, and all
+    # the games they return.
+    @staticmethod
+    def create(tournament_id, usernames):
+        """Returns the tournament, a message, and the first round's games."""
+        usernames = [username.lstrip('@') for username in usernames]
+        if len(usernames) < MIN_TABLE_SIZE:
+            raise engine.Misplay("A tournament needs at least %s players."
+                                 % MIN_TABLE_SIZE)
+        elif len(set(usernames)) != len(usernames):
+            raise engine.Misplay("The players must be unique.")
+        tournament = Tournament(
+            id=tournament_id, nonce='%08x' % random.getrandbits(32), round=0,
+            standings=[Standing(username=username, round=0)
+                       for username in usernames])
+        text, games = tournament._begin_round(usernames)
+        return tournament, text, games
+
+    def _begin_round(self, usernames):
+        """Returns a message, and the tables' games."""
+        self.round += 1
+        self.tables = []
+        games = []
+        lines = ["Round %s:" % self.round]
+        for i, table_usernames in enumerate(seat_players(usernames)):
+            game_id = '%s#%s#%s#%s' % (self.key.id(), self.nonce,
+                                       self.round, i + 1)
+            self.tables.append(Table(game_id=game_id,
+                                     usernames=table_usernames,
+                                     finished=False))
+            self.game_ids.append(game_id)
+            games.append(engine.GameState.create(game_id, table_usernames))
+            lines.append("Table %s: %s; %s goes first." % (
+                i + 1, ' '.join(table_usernames), table_usernames[0]))
+            for username in table_usernames:
+                standing = self.get_standing(username)
+                standing.round = self.round
+                standing.place = None
+                standing.game_id = game_id
+        return '\n'.join(lines), games
+
+    def finish_table(self, game):
+        """Record the result of a finished table's game.
+
+        Returns a message (None if we already knew), and the games for the
+        next round, if it's time to start one.
+        """
+        for table in self.tables:
+            if table.game_id == game.key.id() and not table.finished:
+                break
+        else:
+            return None, []
+        table.finished = True
+        # The first player eliminated places last.
+        places = {game.winner(): 1}
+        for i, username in enumerate(game.eliminated):
+            places[username] = len(table.usernames) - i
+        for username in table.usernames:
+            self.get_standing(username).place = places.get(username)
+        text = "%s won their table in round %s." % (game.winner(), self.round)
+        if not all(table.finished for table in self.tables):
+            return text, []
+
+        advancing = self._advancing()
+        if len(advancing) == 1:
+            self.winner = advancing[0]
+            return '\n'.join([
+                text, "%s has won the tournament!" % self.winner]), []
+        round_text, games = self._begin_round(advancing)
+        return '\n'.join([text, round_text]), games
+
+    def _advancing(self):
+        """Who goes on to the next round.
+
+        Each table's winner, plus, if that's not enough for a table, the best
+        of the rest, taking from earlier tables first.
+        """
+        advancing = []
+        place = 1
+        while True:
+            for table in self.tables:
+                for username in table.usernames:
+                    if self.get_standing(username).place == place:
+                        advancing.append(username)
+                        if (len(self.tables) > 1
+                                and place > 1
+                                and len(advancing) >= MIN_TABLE_SIZE):
+                            return advancing
+            if len(self.tables) == 1 or len(advancing) >= MIN_TABLE_SIZE:
+                return advancing
+            place += 1